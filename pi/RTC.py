@@ -10,17 +10,30 @@ class RTC:
     def __init__(self, i2c):
         self.ready = False
         
+        # T+ is kept with the monotonic clock from this one reference, so it can't jump if the system time is changed under us
+        self.wallRefMS = round(time.time()*1000)
+        self.monoRefNS = time.monotonic_ns()
+        
         try:
-            self.ref = round(time.time()*1000) # This is only used if the RTC can't be found
+            self.ref = self.getTimeMS() # This is only used if the RTC can't be found
             self.ds3231 = adafruit_ds3231.DS3231(i2c)
             self.rtcTime = self.ds3231.datetime
-            self.now = round(time.time()*1000) # Get a fresh reference time
+            self.now = self.getTimeMS() # Get a fresh reference time
             self.tMinus60 = self.now - (((self.rtcTime.tm_min * 60) + self.rtcTime.tm_sec) * 1000) # The oscillator should take an average of 2s to start and calibrate, from the datasheet. However, it seems it accounts for this interenally, so we WILL NOT add the 2 seconds ourselves.
             self.t0 = self.tMinus60 + 60000 # Estimate t0 from RBF at T-60
             self.ready = True
         except:
             print("No RTC is on the i2c line?!")
             
+    def getTimeMS(self):
+        """
+        Get the current time of the device in ms.
+        
+        Measured with the monotonic clock since this object was made, so it
+        only costs a clock read and can't jump with the system time.
+        """
+        return self.wallRefMS + (time.monotonic_ns() - self.monoRefNS) // 1000000
+            
     def setRef(self, ref):
         """
         Set the estimated T0 time if the RTC can't be found.
@@ -31,7 +44,7 @@ class RTC:
         -------
         Difference of new and old t0
         """
-        prior_t0 = self.t0
+        prior_t0 = self.getT0MS() # There's no t0 yet if the RTC was never found
         self.ref = ref
         self.t0 = ref
         self.tMinus60 = self.t0 - 60000
@@ -68,8 +81,8 @@ class RTC:
         Returns approximate time if not ready
         """
         if not self.ready:
-            return round(time.time() - round(self.ref / 1000))
-        return round(time.time() - round(self.t0 / 1000))
+            return round(self.getTimeMS() / 1000 - round(self.ref / 1000))
+        return round(self.getTimeMS() / 1000 - round(self.t0 / 1000))
 
     def getTPlusMS(self):
         """
@@ -78,5 +91,5 @@ class RTC:
         Returns approximate time if not ready
         """
         if not self.ready:
-            return round(time.time()*1000) - self.ref
-        return round(time.time()*1000) - self.t0
\ No newline at end of file
+            return self.getTimeMS() - self.ref
+        return self.getTimeMS() - self.t0
\ No newline at end of file
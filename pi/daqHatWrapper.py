@@ -22,7 +22,7 @@ class WrapDAQHAT:
         self.debug = debug
         self.mprint = mprint
         self.overrun = False
-        self.outputLog = open(str(time()) + '_AccelerationData.csv', 'w') #open file to write to, name it outputLog
+        self.outputLog = open(f"{time()}_AccelerationData.csv", 'w') #open file to write to, name it outputLog
         self.connected = False
         self.connectionAttempts = 0
         
@@ -49,7 +49,7 @@ class WrapDAQHAT:
             self.connected = True
         except:
             self.connected = False
-            self.mprint.p("FAILED TO CONNECT TO MCC128!! Time: " + str(timeMS()) + " ms", self.mainLogFile)
+            self.mprint.p(f"FAILED TO CONNECT TO MCC128!! Time: {timeMS()} ms", self.mainLogFile)
         return self.connected
     
     
@@ -80,14 +80,13 @@ class WrapDAQHAT:
             saves data to file given with timestamps in leftmost column 
             using multiprint
         """
-        data_csv = ''
-        for row in range(len(data)/self.numChannels):
-            data_csv += ("," if (row != int(len(data)/self.numChannels) - 1) else (str(endTime) + ",")) # Only write timestamp to last value
-            for i in range(self.numChannels):
-                data_csv += ("," + str(data[row*self.numChannels + i]))
-            data_csv += "\n"
-        data_csv = data_csv.removesuffix("\n") # Remove trailing newline
-        self.mprint.p(data_csv, self.outputLog)
+        rows = int(len(data) / self.numChannels)
+        lines = []
+        for row in range(rows):
+            stamp = endTime if row == rows - 1 else "" # Only write timestamp to last value
+            values = ",".join(str(value) for value in data[row*self.numChannels:(row + 1)*self.numChannels])
+            lines.append(f"{stamp},,{values}")
+        self.mprint.p("\n".join(lines), self.outputLog)
 
     def read_buffer_write_file(self, endTime=timeMS()):
         """
@@ -117,7 +116,7 @@ class WrapDAQHAT:
                         self.overrun = True
             return self.overrun
         except:
-            self.mprint.p("WAS CONNECTED TO MCC128 BUT CAN'T GET DATA!! Time: " + str(timeMS()) + " ms")
+            self.mprint.p(f"WAS CONNECTED TO MCC128 BUT CAN'T GET DATA!! Time: {timeMS()} ms", self.mainLogFile)
             self.connected = False
             return False
     
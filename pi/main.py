@@ -23,6 +23,7 @@ This STILL NEEDS TO DO:
 # Communications
 from RPi import GPIO
 from statistics import median
+from collections import namedtuple
 
 class Collection:
     """
@@ -41,6 +42,8 @@ class Collection:
     
     up_driving_pressure: The hPa we expect this tank to get on the way up
     down_driving_pressure: The hPa we expect this tank to get on the way down
+    up_threshold, down_threshold: 90% of the driving pressures, which is what the tank pressures are checked against
+    bleed_window: bleed_duration plus the 50 ms margin the bleed valve is held open for
     
     upwards_bleed: Whether this collection needs to be bled on the way up
     
@@ -48,6 +51,10 @@ class Collection:
     mprls: The MPRLS asociated with this collection period
     """
     
+    __slots__ = ("num", "up_start_time", "down_start_time", "up_duration", "down_duration", "bleed_duration", "bleed_window",
+                 "up_driving_pressure", "down_driving_pressure", "up_threshold", "down_threshold",
+                 "upwards_bleed", "tank", "mprls", "sampled", "sample_upwards", "sampled_count")
+    
     def __init__(self, num,
                  up_start_time, down_start_time,
                  bleed_duration,
@@ -62,8 +69,11 @@ class Collection:
         self.up_duration = up_duration
         self.down_duration = down_duration
         self.bleed_duration = bleed_duration
+        self.bleed_window = bleed_duration + 50     # How long the bleed valve is actually held open. +50ms, just to ensure we get everything out
         self.up_driving_pressure = up_driving_pressure
         self.down_driving_pressure = down_driving_pressure
+        self.up_threshold = up_driving_pressure * 0.9       # The tank pressure a good upwards sample has to clear
+        self.down_threshold = down_driving_pressure * 0.9   # The tank pressure a good downwards sample has to clear
         self.upwards_bleed = upwards_bleed
         self.tank = tank
         self.mprls = mprls
@@ -71,10 +81,27 @@ class Collection:
         self.sample_upwards = True  # Set to False if this tank needs to be sampled on the way down
         self.sampled_count = 0      # The number of times we've tried to sample
 
+    def markSampled(self):
+        """Mark this collection and its tank as sampled."""
+        self.tank.sampled = True
+        self.sampled = True
+
+    def resetForDown(self):
+        """Forget the upwards attempts so this collection can be sampled again on the way down."""
+        self.tank.sampled = False
+        self.sampled = False
+        self.sampled_count = 0
+
 # ---- SETTINGS ----
 VERSION = "2.0.0"
 
 DEFAULT_BOOT_TIME = 35000   # The estimated time to boot and run the beginnings of the script, in MS. Will be used only if RTC is not live
+PRESSURE_FLUSH_INTERVAL = 500   # How often the buffered pressure CSV is pushed to the disk, in MS
+SAMPLE_TRIES = 3                # How many times we try to fill a tank before giving up on it
+DEAD_DELTA_HPA = 3              # A dead-tested tank is usable if the canister loses less than this many hPa while it's open
+PRESSURE_LOG_INTERVAL = 20      # How often the sampler thread logs the pressures, in MS
+THREAD_STACK_SIZE = 256 * 1024  # Stack size of the threads we start, in bytes. The 8 MB default would all be pinned by mlockall
+VERBOSE_LOG = False             # Log every valve step. Leave False for flight, so only the INFO lines are written
 
 GPIO_MODE = GPIO.BCM
 VALVE_MAIN_PIN = 27         # Parker 11/25/26 Main Valve control pin
@@ -91,6 +118,10 @@ VALVE_2_PIN = 21 (BOARD) -> 9 (BCM)
 VALVE_3_PIN = 23 (BOARD) -> 11 (BCM)
 """
 
+MPRLS_START_COMMAND = bytes([0xAA, 0x00, 0x00])    # MPRLS "start measurement" command, from the datasheet
+MPRLS_CONVERSION_TIME = 0.005   # How long an MPRLS conversion takes, in seconds. ~5 ms, from the datasheet
+MPRLS_READ_TIMEOUT = 10 * MPRLS_CONVERSION_TIME    # How long read_result() waits on the busy flag before giving up, in seconds
+
 # Setup our Colleciton objects. Numbers from SampleTiming.xlsx in the drive. All durations are going to be the minimum actuation time
 collection_1 = Collection(num = 1,
                           up_start_time = 40305,
@@ -118,6 +149,7 @@ collection_3 = Collection(num = 3,
                           )
 
 collections = [collection_1, collection_2, collection_3]
+swap_priority = [collection_1, collection_3, collection_2]  # The order that collections are given live tanks in swapTanks()
 
 
 
@@ -128,6 +160,8 @@ class Valve:
     pin: The BCM pin of the valve
     """
     
+    __slots__ = ("pin", "name")
+    
     def __init__(self, pin, name):
         self.pin = pin
         self.name = name
@@ -141,6 +175,16 @@ class Valve:
     def close(self):
         """Pull the valve pin LOW."""
         GPIO.output(self.pin, GPIO.LOW)
+    
+    @staticmethod
+    def openMany(valves):
+        """Pull several valve pins HIGH in a single GPIO call, so they open together."""
+        GPIO.output([valve.pin for valve in valves], GPIO.HIGH)
+    
+    @staticmethod
+    def closeMany(valves):
+        """Pull several valve pins LOW in a single GPIO call, so they close together."""
+        GPIO.output([valve.pin for valve in valves], GPIO.LOW)
 
 class Tank:
     """
@@ -150,6 +194,8 @@ class Tank:
     collection: The sample collection object
     """
     
+    __slots__ = ("valve", "mprls", "sampled", "dead")
+    
     def __init__(self, valve):
         self.valve = valve
         self.mprls = WrapMPRLS()
@@ -167,12 +213,19 @@ class WrapMPRLS:
     """
     Wrap the MPRLS library to prevent misreads.
     
+    start_conversion() and read_result() talk to the sensor through adafruit_mprls internals
+    (_i2c, _psimax, _psimin), so the library version is pinned in requirements.txt.
+    
     multiplexerLine: The multiplexed i2c line. If not specified, this object will become dormant
     """
     
+    __slots__ = ("cantConnect", "mprls", "lock", "_buffer")
+    
     def __init__(self, multiplexerLine=False):
         self.cantConnect = False
         self.mprls = False
+        self.lock = threading.Lock()    # Held from start_conversion() to read_result(), so two threads can't interleave conversions on this MPRLS
+        self._buffer = bytearray(4)     # Status byte + 24-bit reading
         
         if not multiplexerLine: # No multiplexer defined, therefore this is a blank object
             self.cantConnect = True
@@ -182,60 +235,96 @@ class WrapMPRLS:
             self.mprls = adafruit_mprls.MPRLS(multiplexerLine, psi_min=0, psi_max=25)
         except:
             self.cantConnect = True
+
+    def start_conversion(self):
+        """
+        Send the start-measurement command to the MPRLS without waiting for the result.
+
+        Pair with read_result() so that several MPRLS can convert (~5 ms) at the same time.
+        Hold self.lock from here until read_result() returns.
+        """
+        if self.cantConnect: return
+        with self.mprls._i2c as i2c:
+            i2c.write(MPRLS_START_COMMAND)
+
+    def read_result(self):
+        """
+        Wait for the measurement started by start_conversion() to finish and read it.
+        
+        The bus is only held for each poll of the busy flag, so a stuck MPRLS can't lock
+        out the others, and the wait gives up after MPRLS_READ_TIMEOUT.
+
+        Returns
+        -------
+        The pressure in hPa or -1 if we can't connect to it
         
+        Raises RuntimeError if the conversion times out or the MPRLS reports an error
+        """
+        if self.cantConnect: return -1
+        buffer = self._buffer
+        deadline = time.monotonic() + MPRLS_READ_TIMEOUT
+        while True:
+            with self.mprls._i2c as i2c:
+                i2c.readinto(buffer, end=1)
+                if not buffer[0] & 0x20:    # The busy flag has cleared
+                    i2c.readinto(buffer, end=4)
+                    break
+            if time.monotonic() > deadline:
+                raise RuntimeError("Timed out waiting for the conversion")
+            time.sleep(0.0005)  # Let the other MPRLS have the bus between polls
+
+        if buffer[0] & 0x01:
+            raise RuntimeError("Internal math saturation")
+        if buffer[0] & 0x04:
+            raise RuntimeError("Integrity failure")
+
+        # Same 10-90% calibration curve and PSI -> hPa conversion as adafruit_mprls
+        raw_psi = (buffer[1] << 16) | (buffer[2] << 8) | buffer[3]
+        psi = (raw_psi - 0x19999A) * (self.mprls._psimax - self.mprls._psimin)
+        psi /= 0xE66666 - 0x19999A
+        psi += self.mprls._psimin
+        return psi * 68.947572932
+
     def _get_pressure(self):
         if self.cantConnect: return -1
-        return self.mprls.pressure
+        try:
+            with self.lock:     # The sampler can't start a conversion on this MPRLS in the middle of ours
+                self.start_conversion()
+                time.sleep(MPRLS_CONVERSION_TIME)
+                return self.read_result()
+        except (RuntimeError, OSError):     # A failed read can't be allowed to stop the valve sequencing
+            return -1
 
     def _get_triple_pressure(self):
         if self.cantConnect: return -1
-        pressures = []
-        for e in range(3):
-            pressures.append(self.mprls.pressure)
-            if e < 2: time.sleep(0.005) # MPRLS sample rate is 200 Hz https://forums.adafruit.com/viewtopic.php?p=733797
-            
-        return median(pressures)
-    
-    def _set_pressure(self, value):
-        pass
-
-    def _del_pressure(self):
-        pass
+        # Each read waits out a full conversion, which keeps us under the MPRLS' 200 Hz sample rate https://forums.adafruit.com/viewtopic.php?p=733797
+        return median([self._get_pressure() for e in range(3)])
         
     """
         Acts as a wrapper for the pressure property of the standard MPRLS
     """
     pressure = property(
         fget=_get_pressure,
-        fset=_set_pressure,
-        fdel=_del_pressure,
-        doc="The pressure of the MPRLS or -1 if we can't connect to it"
+        doc="The pressure of the MPRLS or -1 if we can't connect to it or the read fails"
     )
     
     """
-        Adds ~10 ms of delay!
+        Adds ~15 ms of delay!
         Acts as a wrapper for the pressure property of the standard MPRLS.
     """
     triple_pressure = property(
         fget=_get_triple_pressure,
-        fset=_set_pressure,
-        fdel=_del_pressure,
         doc="The 3-sample median pressure of the MPRLS or -1 if we can't connect to it"
     )
 
 
-class PressuresOBJ:
-    """Gather pressure information nicely."""
+"""
+    Gather pressure information nicely.
     
-    def __init__(self, time_MS, TPlus_MS,
-                 canister_pressure, bleed_pressure, tank_1_pressure, tank_2_pressure, tank_3_pressure):
-        self.time_MS = time_MS
-        self.TPlus_MS = TPlus_MS
-        self.canister_pressure = canister_pressure
-        self.bleed_pressure = bleed_pressure
-        self.tank_1_pressure = tank_1_pressure
-        self.tank_2_pressure = tank_2_pressure
-        self.tank_3_pressure = tank_3_pressure
+    A namedtuple, so the object made for every pressure sample has no __dict__.
+"""
+PressuresOBJ = namedtuple("PressuresOBJ", ["time_MS", "TPlus_MS",
+                                           "canister_pressure", "bleed_pressure", "tank_1_pressure", "tank_2_pressure", "tank_3_pressure"])
 
 
 import time
@@ -249,22 +338,35 @@ TIME_LAUNCH_MS = -1
 
 # System control, like file writing
 import os
-from multiprint import MultiPrinter
+import subprocess
+import ctypes
+import threading
+threading.stack_size(THREAD_STACK_SIZE)    # Before any thread starts, so none of ours has an 8 MB stack to lock
+from multiprint import MultiPrinter, DEBUG, INFO
 
-mprint = MultiPrinter()
+mprint = MultiPrinter(level=DEBUG if VERBOSE_LOG else INFO)
 
-output_log = open(str(time.time()) + '_output.txt', 'x') # Our main output file will be named as ${time}_output.txt
-output_pressures = open(str(time.time()) + '_pressures.csv', 'x') # Our pressure output file will be named as ${time}_pressures.csv
+file_time = time.time()     # One timestamp, so both files of a run share their name
+output_log = open(f"{file_time}_output.txt", 'x') # Our main output file will be named as ${time}_output.txt
+output_pressures = open(f"{file_time}_pressures.csv", 'xb', buffering=65536) # Our pressure output file will be named as ${time}_pressures.csv. Buffered and binary, see writePressures()
 
-mprint.p("time & sys imported, files open. Time: " + str(timeMS()) + " ms\tFirst script on: " + str(FIRST_ON_MS) + " ms", output_log)
-mprint.p("Version " + str(VERSION) + ". Time: " + str(timeMS()) + " ms", output_log)
-mprint.w("Time (ms),T+ (ms),Pressure Canister (hPa),Pressure Bleed (hPa),Pressure Valve 1 (hPa),Pressure Valve 2 (hPa),Pressure Valve 3 (hPa)", output_pressures) # Set up our CSV headers
+mprint.p(f"time & sys imported, files open. Time: {timeMS()} ms\tFirst script on: {FIRST_ON_MS} ms", output_log)
+mprint.p(f"Version {VERSION}. Time: {timeMS()} ms", output_log)
+output_pressures.write(b"Time (ms),T+ (ms),Pressure Canister (hPa),Pressure Bleed (hPa),Pressure Valve 1 (hPa),Pressure Valve 2 (hPa),Pressure Valve 3 (hPa)\n") # Set up our CSV headers. Written directly so it lands ahead of the rows from writePressures()
+
+# Keep the scheduler from adding jitter to the sampling. Needs root. Memory is locked once startup is done, see below
+try:
+    os.nice(-20)    # Highest normal priority
+    mprint.p(f"Process priority elevated. Time: {timeMS()} ms", output_log)
+except OSError:
+    mprint.p(f"Couldn't elevate process priority!! Are we not running as sudo? Time: {timeMS()} ms", output_log)
 
 # Sensors
 from adafruit_extended_bus import ExtendedI2C as I2C
-import adafruit_tca9548a
 import adafruit_mprls
 from RTC import RTC  # Our home-built Realtime Clock lib
+from multiplexer import Multiplexer  # TCA9548A that skips reselecting the same channel
+from concurrent.futures import ThreadPoolExecutor
 
 # Init GPIO
 #   We do this before connecting to i2c devices because we want to make sure our valves are closed!
@@ -276,27 +378,26 @@ valve_bleed = Valve(VALVE_BLEED_PIN, "bleed")
 valve_1 = Valve(VALVE_1_PIN, "1")
 valve_2 = Valve(VALVE_2_PIN, "2")
 valve_3 = Valve(VALVE_3_PIN, "3")
+valves_all = (valve_main, valve_bleed, valve_1, valve_2, valve_3)
 
 # Pull all the gates low
-valve_main.close()
-valve_bleed.close()
-valve_1.close()
-valve_2.close()
-valve_3.close()
-mprint.p("Valves pulled LOW. Time: " + str(timeMS()) + " ms", output_log)
+Valve.closeMany(valves_all)
+mprint.p(f"Valves pulled LOW. Time: {timeMS()} ms", output_log)
 
 # Init i2c
+# The bus clock can't be set from here on Linux, the frequency argument is ignored. Run the bus in fast mode (400 kHz),
+# which the MPRLS, TCA9548A and DS3231 all support, with dtparam=i2c_arm_baudrate=400000 in /boot/config.txt
 i2c = I2C(1)    # Use i2c bus #1
 time.sleep(2)   # Needed to ensure i2c is properly initialized
-mprint.p("i2c initialized. Time: " + str(timeMS()) + " ms", output_log)
+mprint.p(f"i2c initialized. Time: {timeMS()} ms", output_log)
 
 # Connect to i2c devices
 multiplex = False
 try:
-    multiplex = adafruit_tca9548a.TCA9548A(i2c)
-    mprint.p("Multiplexer connected. Time: " + str(timeMS()) + " ms", output_log)
+    multiplex = Multiplexer(i2c)
+    mprint.p(f"Multiplexer connected. Time: {timeMS()} ms", output_log)
 except:
-    mprint.p("COULD NOT CONNECT TO MULTIPLEXER!! Time: " + str(timeMS()) + " ms", output_log)
+    mprint.p(f"COULD NOT CONNECT TO MULTIPLEXER!! Time: {timeMS()} ms", output_log)
 
 # Create blank objects
 mprls_canister = WrapMPRLS()
@@ -306,61 +407,72 @@ mprls_tank_2 = WrapMPRLS()
 mprls_tank_3 = WrapMPRLS()
 
 if multiplex != False:
-    # Canister MPRLS
-    mprls_canister = WrapMPRLS(multiplexerLine=multiplex[0])
-    if mprls_canister.cantConnect:
-        mprint.p("COULD NOT CONNECT TO CANISTER MPRLS!! Time: " + str(timeMS()) + " ms", output_log)
-
-    # Bleed Tank MPRLS
-    mprls_bleed = WrapMPRLS(multiplexerLine=multiplex[1])
-    if mprls_bleed.cantConnect:
-        mprint.p("COULD NOT CONNECT TO BLEED MPRLS!! Time: " + str(timeMS()) + " ms", output_log)
-
-    # Tank 1 MPRLS
-    mprls_tank_1 = WrapMPRLS(multiplexerLine=multiplex[2])
-    if mprls_tank_1.cantConnect:
-        mprint.p("COULD NOT CONNECT TO TANK 1 MPRLS!! Time: " + str(timeMS()) + " ms", output_log)
-
-    # Tank 2 MPRLS
-    mprls_tank_2 = WrapMPRLS(multiplexerLine=multiplex[3])
-    if mprls_tank_2.cantConnect:
-        mprint.p("COULD NOT CONNECT TO TANK 2 MPRLS!! Time: " + str(timeMS()) + " ms", output_log)
-
-    # Tank 3 MPRLS
-    mprls_tank_3 = WrapMPRLS(multiplexerLine=multiplex[4])
-    if mprls_tank_3.cantConnect:
-        mprint.p("COULD NOT CONNECT TO TANK 3 MPRLS!! Time: " + str(timeMS()) + " ms", output_log)
-    
-    mprint.p("MPRLS' connected. Time: " + str(timeMS()) + " ms", output_log)
+    # Connect to every MPRLS at once. The multiplexer takes turns on the bus for them
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        mprls_connecting = [executor.submit(WrapMPRLS, multiplexerLine=multiplex[channel]) for channel in range(5)]
+    mprls_canister, mprls_bleed, mprls_tank_1, mprls_tank_2, mprls_tank_3 = [connecting.result() for connecting in mprls_connecting]
+    
+    for mprls, name in ((mprls_canister, "CANISTER"), (mprls_bleed, "BLEED"), (mprls_tank_1, "TANK 1"), (mprls_tank_2, "TANK 2"), (mprls_tank_3, "TANK 3")):
+        if mprls.cantConnect:
+            mprint.p(f"COULD NOT CONNECT TO {name} MPRLS!! Time: {timeMS()} ms", output_log)
+    
+    mprint.p(f"MPRLS' connected. Time: {timeMS()} ms", output_log)
 else:
-    mprint.p("NOT CONNECTING TO THE MPRLS because there's no multiplexer on the line!!. Time: " + str(timeMS()) + " ms", output_log)
+    mprint.p(f"NOT CONNECTING TO THE MPRLS because there's no multiplexer on the line!!. Time: {timeMS()} ms", output_log)
+
+mprls_all = (mprls_canister, mprls_bleed, mprls_tank_1, mprls_tank_2, mprls_tank_3) # In the same order as the pressures CSV
 
 # Connect to the RTC
 rtc = RTC(i2c)
 
 # Establish our T0
 time_try_rtc = timeMS()
-while (not rtc.isReady()) and (time_try_rtc + 3000 > timeMS()): # Wait for up to 3 seconds for RTC.
-    pass
+while (not rtc.isReady()) and (timeMS() - time_try_rtc < 3000): # Wait for up to 3 seconds for RTC.
+    time.sleep(0.01)    # Don't spin the CPU while we wait
 
 if rtc.isReady():
 
     TIME_LAUNCH_MS = rtc.getT0MS()
     
-    mprint.pform("Got RTC after " + str(timeMS() - time_try_rtc) + " ms\tT0: " + str(TIME_LAUNCH_MS) + " ms", rtc.getTPlusMS(), output_log)
+    mprint.pform(f"Got RTC after {timeMS() - time_try_rtc} ms\tT0: {TIME_LAUNCH_MS} ms", rtc.getTPlusMS(), output_log)
     
 else:   # Bruh. No RTC on the line. Guess that's it.
 
     TIME_LAUNCH_MS = FIRST_ON_MS - DEFAULT_BOOT_TIME + 60000 # We'll assume 35 seconds in, based on lab testing. Add 60 seconds from 1.SYS.1 Early Activation
     rtc.setRef(TIME_LAUNCH_MS)
     
-    mprint.p("NO RTC!! Going to assume it's 35 seconds past T-60. Time: " + str(timeMS()) + " ms", output_log)
-    mprint.pform("T0: " + str(TIME_LAUNCH_MS) + " ms", rtc.getTPlusMS(), output_log)
+    mprint.p(f"NO RTC!! Going to assume it's 35 seconds past T-60. Time: {timeMS()} ms", output_log)
+    mprint.pform(f"T0: {TIME_LAUNCH_MS} ms", rtc.getTPlusMS(), output_log)
 
 
-def logPressures():
+last_pressures_flush = timeMS()
+
+def flushPressures():
+    """Push the buffered pressure CSV rows to the disk. The flush and fsync happen on the MultiPrinter's writer thread."""
+    global last_pressures_flush
+    mprint.sync(output_pressures)
+    last_pressures_flush = timeMS()
+
+
+def writePressures(pressures):
+    """
+    Write a Pressure object as a row of the pressures CSV.
+    
+    The rows are buffered and only flushed to the disk every PRESSURE_FLUSH_INTERVAL ms,
+    instead of a write + fsync for every sample.
+    The row is formatted straight to bytes, so there's no str to build and encode.
+    """
+    output_pressures.write(b"%d,%d,%.3f,%.3f,%.3f,%.3f,%.3f\n" % pressures)
+    if pressures.time_MS - last_pressures_flush >= PRESSURE_FLUSH_INTERVAL:
+        flushPressures()
+
+
+def logPressures(tplus=None):
     """
     Get the pressures from every MPRLS and logs them to the CSV output.
+    All MPRLS convert at the same time, so this takes ~1 conversion instead of 5.
+    
+    tplus: The T+ to log the sample at, if the caller just read it. Otherwise the RTC is read
     
     Returns a Pressure object with the pressure and time info:
             System Time (ms),
@@ -371,8 +483,19 @@ def logPressures():
             Tank 2 Pressure (hpa),
             Tank 3 Pressure (hpa)
     """
-    pressures = PressuresOBJ(timeMS(), rtc.getTPlusMS(), mprls_canister.pressure, mprls_bleed.pressure, mprls_tank_1.pressure, mprls_tank_2.pressure, mprls_tank_3.pressure)
-    mprint.p(str(pressures.time_MS) + "," + str(pressures.TPlus_MS) + "," + str(pressures.canister_pressure) + "," + str(pressures.bleed_pressure) + "," + str(pressures.tank_1_pressure) + "," + str(pressures.tank_2_pressure) + "," + str(pressures.tank_3_pressure), output_pressures)
+    for mprls in mprls_all:
+        mprls.lock.acquire()    # The main thread only ever holds one of these, so always taking them in this order can't deadlock
+    try:
+        for mprls in mprls_all:
+            mprls.start_conversion()
+        time.sleep(MPRLS_CONVERSION_TIME)   # Sleep through the conversion, so read_result() usually sees the busy flag clear on its first poll
+        if tplus is None:
+            tplus = rtc.getTPlusMS()
+        pressures = PressuresOBJ(timeMS(), tplus, *[mprls.read_result() for mprls in mprls_all])
+    finally:
+        for mprls in mprls_all:
+            mprls.lock.release()
+    writePressures(pressures)
     return pressures
 
 
@@ -390,10 +513,69 @@ def logPressuresTriple():
             Tank 2 Pressure (hpa),
             Tank 3 Pressure (hpa)
     """
-    pressures = PressuresOBJ(timeMS(), rtc.getTPlusMS(), mprls_canister.triple_pressure, mprls_bleed.triple_pressure, mprls_tank_1.triple_pressure, mprls_tank_2.triple_pressure, mprls_tank_3.triple_pressure)
-    mprint.p(str(pressures.time_MS) + "," + str(pressures.TPlus_MS) + "," + str(pressures.canister_pressure) + "," + str(pressures.bleed_pressure) + "," + str(pressures.tank_1_pressure) + "," + str(pressures.tank_2_pressure) + "," + str(pressures.tank_3_pressure), output_pressures)
+    pressures = PressuresOBJ(timeMS(), rtc.getTPlusMS(), *[mprls.triple_pressure for mprls in mprls_all])
+    writePressures(pressures)
     return pressures
 
+
+class Sampler(threading.Thread):
+    """
+    Log the pressures every period ms on a thread of its own, so the valve timing
+    on the main thread never waits on the I2C bus.
+    
+    The period is kept with the monotonic clock, so the G-Switch moving T0 can't stall it.
+    
+    period: How often to log the pressures, in ms
+    """
+    
+    def __init__(self, period=PRESSURE_LOG_INTERVAL):
+        super().__init__(name="Sampler", daemon=True)
+        self.period = period
+        self.running = True
+        
+    def run(self):
+        failing = False     # Only log the first error of a run of failed samples
+        next_time = time.monotonic()
+        while self.running:
+            try:
+                logPressures()
+                if failing:
+                    mprint.pform("Sampler is logging the pressures again", rtc.getTPlusMS(), output_log)
+                    failing = False
+            except Exception as e:  # One bad read can't be allowed to end the pressure log for the rest of the flight
+                if not failing:
+                    mprint.pform(f"SAMPLER COULD NOT LOG THE PRESSURES! Error: {e!r}", rtc.getTPlusMS(), output_log)
+                    failing = True
+            next_time += self.period / 1000
+            now = time.monotonic()
+            if next_time > now:
+                time.sleep(next_time - now)
+            else:   # We fell behind, so start counting from now instead of rushing to catch up
+                next_time = now
+    
+    def stop(self):
+        """Stop sampling and wait for the last sample to be logged."""
+        self.running = False
+        self.join()
+
+sampler = Sampler()
+
+
+def waitUntil(tplus, period=PRESSURE_LOG_INTERVAL):
+    """
+    Sleep until the T+ reaches tplus. The sampler logs the pressures in the meantime.
+    
+    The sleep is done in slices of at most period ms, rereading the T+ after each one,
+    so a G-Switch moving T0 mid-wait moves the deadline with it.
+    
+    tplus:  The T+ to wait for, in ms
+    period: The longest slice to sleep before checking the T+ again, in ms
+    """
+    now_tp = rtc.getTPlusMS()
+    while now_tp < tplus:
+        time.sleep(min(period, tplus - now_tp) / 1000)
+        now_tp = rtc.getTPlusMS()
+
 # Get our first pressure readings
 logPressures()
 
@@ -411,11 +593,22 @@ def gswitch_callback(channel):
     None.
 
     """
-    t0 = timeMS()
-    GPIO.remove_event_detect(GSWITCH_PIN)
+    t0 = rtc.getTimeMS()    # Stamp the edge first thing, on the same monotonic clock that T+ is measured with
     difference = rtc.setRef(t0)
-    mprint.pform("G-Switch input! New t0: " + str(t0) + " ms. Difference from RBF estimation: " + str(difference) + " ms", rtc.getTPlusMS(), output_log)
+    GPIO.remove_event_detect(GSWITCH_PIN)
+    mprint.pform(f"G-Switch input! New t0: {t0} ms. Difference from RBF estimation: {difference} ms", rtc.getTPlusMS(), output_log)
     
+# Keep page faults from adding jitter to the sampling. Needs root
+# Only MCL_CURRENT, after startup: everything is imported and connected by now, and the threads
+# started later (RPi.GPIO's event thread has an 8 MB stack we can't shrink) don't get pinned whole
+try:
+    libc = ctypes.CDLL("libc.so.6", use_errno=True)
+    if libc.mlockall(1) != 0:   # MCL_CURRENT, keep every page we have now in RAM
+        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    mprint.pform("Memory locked.", rtc.getTPlusMS(), output_log)
+except OSError as e:
+    mprint.pform(f"Couldn't lock memory!! {e}", rtc.getTPlusMS(), output_log)
+
 # Setup the G-Switch listener
 GPIO.setup(GSWITCH_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 GPIO.add_event_detect(GSWITCH_PIN, GPIO.FALLING,
@@ -442,21 +635,34 @@ collection_3.mprls = mprls_tank_3
 
 # FUN BITS HERE
 def initialPressureCheck():
-    tanks = [tank_1, tank_2, tank_3, tank_bleed]
     mprint.pform("Performing Initial Pressure Check.", rtc.getTPlusMS(), output_log)
     
-    for tank in tanks:
+    pressures = logPressures()  # Every MPRLS converts at once, instead of one blocking read per tank
+    tanks = [(tank_1, pressures.tank_1_pressure), (tank_2, pressures.tank_2_pressure), (tank_3, pressures.tank_3_pressure), (tank_bleed, pressures.bleed_pressure)]
+    
+    for tank, pressure in tanks:
         if tank.mprls.cantConnect:
-            mprint.pform("Pressure in Tank " + tank.valve.name + " cannot be determined! Marked it as dead", rtc.getTPlusMS(), output_log)
+            mprint.pform(f"Pressure in Tank {tank.valve.name} cannot be determined! Marked it as dead", rtc.getTPlusMS(), output_log)
             tank.dead = True
-        elif tank.mprls.pressure > 900:
-            mprint.pform("Pressure in Tank " + tank.valve.name + " is atmospheric. Marked it as dead", rtc.getTPlusMS(), output_log)
+        elif pressure > 900:
+            mprint.pform(f"Pressure in Tank {tank.valve.name} is atmospheric. Marked it as dead", rtc.getTPlusMS(), output_log)
             tank.dead = True
         else:
-            mprint.pform("Pressure in Tank " + tank.valve.name + " is " + str(tank.mprls.pressure) + ". All good.", rtc.getTPlusMS(), output_log)
+            mprint.pform(f"Pressure in Tank {tank.valve.name} is {pressure}. All good.", rtc.getTPlusMS(), output_log)
 
 initialPressureCheck()
 
+def swapCollectionTanks(collection, other, reason):
+    """
+    Swap the tanks of two collections and log why.
+    
+    reason: Why the swap is being made, finishing the log line
+    """
+    mprint.pform(f"SWAPPING TANK {collection.tank.valve.name} FOR TANK {other.tank.valve.name}. This is because {reason}", rtc.getTPlusMS(), output_log)
+    collection.tank, other.tank = other.tank, collection.tank
+    collection.mprls = collection.tank.mprls
+    other.mprls = other.tank.mprls
+
 def swapTanks():
     """
     Asseses the pressures of the tanks and swaps tanks between collections, if possible.
@@ -465,167 +671,120 @@ def swapTanks():
         much as valid. However, since Collection 1 actually brings in more air,
         it's the most likely to bring in results.
 
+    Each live tank's pressure is read once. Only collections that can't be sampled
+    with their own tank are swapped, in swap_priority order:
+        A collection with a dead tank takes the live tank of the lowest priority collection below it.
+        A collection whose tank is too high takes a tank that satisfies it, preferring a swap that
+        leaves both collections good, and otherwise taking it from the lowest priority collection below it.
+    This is a greedy pass, so it won't find every assignment that would work.
+
     Returns
     -------
-    None.
+    True if every collection has a live tank that can be sampled on the way up.
 
     """
     mprint.pform("Checking the pressures in the tanks for swaps...", rtc.getTPlusMS(), output_log)
     
-    if collection_3.tank.dead:
-        if collection_1.tank.dead:
-            if collection_2.tank.dead:
-                mprint.pform("All tanks are dead! We will wait for the dead test to collect.", rtc.getTPlusMS(), output_log)
-                return False
-            else:
-                mprint.pform("SWAPPING TANK 2 FOR TANK 3. This is because T1 & T3 are dead and T3 gets priority.", rtc.getTPlusMS(), output_log)
-                collection_2.tank = tank_3
-                collection_2.mprls = mprls_tank_3
-                collection_3.tank = tank_2
-                collection_3.mprls = mprls_tank_2
-        else:
-            mprint.pform("SWAPPING TANK 1 FOR TANK 3. This is because T3 is dead and T3 gets priority.", rtc.getTPlusMS(), output_log)
-            collection_1.tank = tank_3
-            collection_1.mprls = mprls_tank_3
-            collection_3.tank = tank_1
-            collection_3.mprls = mprls_tank_1
-            return swapTanks()
-    else:
-        if collection_1.tank.dead:
-            if collection_2.tank.dead:
-                mprint.pform("Tank 3 is the only alive sample tank. Leaving it alone for now.", rtc.getTPlusMS(), output_log)
-            else:
-                mprint.pform("SWAPPING TANK 1 FOR TANK 2. This is because T1 is dead and T1 gets priority over T2.", rtc.getTPlusMS(), output_log)
-                collection_1.tank = tank_2
-                collection_1.mprls = mprls_tank_2
-                collection_2.tank = tank_1
-                collection_2.mprls = mprls_tank_1
-        else:
-            if collection_2.tank.dead:
-                mprint.pform("Tank 2 is the only dead sample tank. As it has last priority, we are leaving it alone for now.", rtc.getTPlusMS(), output_log)
-    
-    if not collection_2.tank.dead:
-        if collection_3.mprls.pressure >= collection_3.up_driving_pressure:
-            if collection_1.mprls.pressure >= collection_3.up_driving_pressure:
-                if not (collection_2.mprls.pressure >= collection_3.up_driving_pressure):
-                    mprint.pform("SWAPPING TANK 2 FOR TANK 3. This is because T2's pressure satisfies C3, while neither T1 or T3 do.", rtc.getTPlusMS(), output_log)
-                    collection_2.tank = tank_3
-                    collection_2.mprls = mprls_tank_3
-                    collection_3.tank = tank_2
-                    collection_3.mprls = mprls_tank_2
-            else:
-                mprint.pform("SWAPPING TANK 1 FOR TANK 3. This is because T1's pressure satisfies C3, while T3 doesn't.", rtc.getTPlusMS(), output_log)
-                collection_1.tank = tank_3
-                collection_1.mprls = mprls_tank_3
-                collection_3.tank = tank_1
-                collection_3.mprls = mprls_tank_1
-        
-        if collection_2.mprls.pressure >= collection_2.up_driving_pressure:
-            if collection_1.tank.pressure >= collection_2.up_driving_pressure:
-                mprint.pform("Collection 2's Tank (" + str(collection_2.tank.valve.name) + ") is too high to sample. There is no tank to replace it. It needs to be equalized or some other method.", rtc.getTPlusMS(), output_log)
-                # TODO: Ask Camden what logic should be taken from here, if not just sampling on the way down.
-                collection_2.sample_upwards = False
-                return False
-            else:
-                mprint.pform("SWAPPING TANK 1 FOR TANK 2. This is because T1's pressure satisfies C2, while T2 doesn't.", rtc.getTPlusMS(), output_log)
-                collection_1.tank = tank_2
-                collection_1.mprls = mprls_tank_2
-                collection_2.tank = tank_1
-                collection_2.mprls = mprls_tank_1
-                return False
-        else:
-            mprint.pform("Collection 2's Tank (" + str(collection_2.tank.valve.name) + ") is below it's driving pressure and is good to sample.", rtc.getTPlusMS(), output_log)
-            return False
-    else:
-        if collection_3.mprls.pressure >= collection_3.up_driving_pressure:
-            if not collection_1.tank.dead:
-                mprint.pform("SWAPPING TANK 1 FOR TANK 3. This is because T1's pressure satisfies C3, while T3 doesn't and T2 is dead.", rtc.getTPlusMS(), output_log)
-                collection_1.tank = tank_3
-                collection_1.mprls = mprls_tank_3
-                collection_3.tank = tank_1
-                collection_3.mprls = mprls_tank_1
-                return False
-            else:
-                mprint.pform("Collection 3's Tank (" + str(collection_3.tank.valve.name) + ") is too high to sample. There is no tank to replace it. It needs to be equalized or some other method.", rtc.getTPlusMS(), output_log)
-                # TODO: Ask Camden what logic should be taken from here, if not just sampling on the way down.
-                collection_3.sample_upwards = False
-                return False
+    pressures = {collection.tank: collection.tank.mprls.pressure for collection in collections if not collection.tank.dead}
+    
+    if not pressures:
+        mprint.pform("All tanks are dead! We will wait for the dead test to collect.", rtc.getTPlusMS(), output_log)
+        return False
+    
+    for i, collection in enumerate(swap_priority):
+        if collection.tank.dead:
+            donors = [other for other in swap_priority[i + 1:] if not other.tank.dead]
+            if donors:
+                swapCollectionTanks(collection, donors[-1], f"T{collection.tank.valve.name} is dead and C{collection.num} gets priority over C{donors[-1].num}.")
+    
+    live_collections = [collection for collection in swap_priority if not collection.tank.dead]
+    for i, collection in enumerate(live_collections):
+        if pressures[collection.tank] < collection.up_driving_pressure:
+            continue
+        candidates = [other for other in live_collections if other is not collection and pressures[other.tank] < collection.up_driving_pressure]
+        partner = next((other for other in candidates if pressures[collection.tank] < other.up_driving_pressure), None)  # A swap that's good for both
+        if partner is None:
+            lower = [other for other in candidates if live_collections.index(other) > i]
+            partner = lower[-1] if lower else None
+        if partner is not None:
+            swapCollectionTanks(collection, partner, f"T{partner.tank.valve.name}'s pressure satisfies C{collection.num}, while T{collection.tank.valve.name} doesn't.")
+    
+    all_good = True
+    for collection in swap_priority:
+        if collection.tank.dead:
+            mprint.pform(f"Tank {collection.tank.valve.name} in collection {collection.num} is dead. There is no live tank to spare, so we are leaving it alone for now.", rtc.getTPlusMS(), output_log)
+            all_good = False
+        elif pressures[collection.tank] >= collection.up_driving_pressure:
+            mprint.pform(f"Collection {collection.num}'s Tank ({collection.tank.valve.name}) is too high to sample. There is no tank to replace it. It needs to be equalized or some other method.", rtc.getTPlusMS(), output_log)
+            # TODO: Ask Camden what logic should be taken from here, if not just sampling on the way down.
+            collection.sample_upwards = False
+            all_good = False
         else:
-            mprint.pform("All tanks are alive and of the correct vacuumed pressures. Leaving the system be.", rtc.getTPlusMS(), output_log)
-            return True
+            mprint.pform(f"Collection {collection.num}'s Tank ({collection.tank.valve.name}) is below it's driving pressure and is good to sample.", rtc.getTPlusMS(), output_log)
+    
+    if all_good:
+        mprint.pform("All tanks are alive and of the correct vacuumed pressures. Leaving the system be.", rtc.getTPlusMS(), output_log)
+    return all_good
             
 swapTanks()
 mprint.pform("swapTanks complete.", rtc.getTPlusMS(), output_log)
 
+def equalizeCollection(collection, partners, pressures):
+    """
+    Equalize a collection's tank with another tank if its pressure is too high to sample.
+    
+    collection: The collection whose tank is checked
+    partners:   The collections whose tanks it can be equalized with, in order of preference
+    pressures:  The pressure of each sample tank, in hPa
+    """
+    tank = collection.tank
+    pressure = pressures[tank]
+    if pressure <= collection.up_threshold or tank.sampled:
+        return
+    
+    mprint.pform(f"Pressure in Tank {tank.valve.name} is too large for collection! - {pressure} hPa", rtc.getTPlusMS(), output_log)
+    
+    if pressure >= 900: # Tank lost everything in the 5 days we waited. Mark it as dead
+        mprint.pform(f"Pressure in Tank {tank.valve.name} is atmospheric. Marked it as dead", rtc.getTPlusMS(), output_log)
+        tank.dead = True
+        collection.sample_upwards = False
+        return
+    
+    # If the tank is holding *some* sort of vacuum, just not a good one...
+    mprint.pform(f"Pressure in Tank {tank.valve.name} is below atmospheric", rtc.getTPlusMS(), output_log)
+    for partner in partners:
+        other = partner.tank
+        if not other.mprls.cantConnect and (pressure + pressures[other]) / 2 < collection.up_threshold: # Let's equalize the two tanks
+            mprint.pform(f"Pressure in Tank {tank.valve.name} can be equalized with Tank {other.valve.name}. Let's do that", rtc.getTPlusMS(), output_log)
+            Valve.openMany((other.valve, tank.valve))
+            mprint.pform(f"VALVE_{other.valve.name} and VALVE_{tank.valve.name} pulled HIGH", rtc.getTPlusMS(), output_log, level=DEBUG)
+            time.sleep(0.1)
+            Valve.closeMany((other.valve, tank.valve))
+            mprint.pform(f"VALVE_{other.valve.name} and VALVE_{tank.valve.name} pulled LOW", rtc.getTPlusMS(), output_log, level=DEBUG)
+            return
+    
+    mprint.pform(f"Pressure in Tank {tank.valve.name} can't be equalized. We'll sample it on the way down", rtc.getTPlusMS(), output_log)
+    collection.sample_upwards = False
+
 def equalizeTanks():
     """
     Asseses the pressures of the tanks and equalize the pressures.
     
     If necessary, connections between 2 tanks will be opened to equalize
-    a larger pressure with a smaller pressure tank.
+    a larger pressure with a smaller pressure tank. The tanks are taken from
+    the collections, so this follows any swaps made by swapTanks().
     """
     mprint.pform("Checking the pressures in the tanks for equalization...", rtc.getTPlusMS(), output_log)
     
     pressures = logPressuresTriple()
+    tank_pressures = {tank_1: pressures.tank_1_pressure, tank_2: pressures.tank_2_pressure, tank_3: pressures.tank_3_pressure}
     
-    if (mprls_tank_3.cantConnect == True or mprls_tank_2.cantConnect == True) and mprls_tank_1.cantConnect == True: # Not enough pressure information to equalize the tanks
-        mprint.pform("Can't connect to two or more of the MPRLS, so we will not attempt to equalize the tanks. Connections - MPRLS3: " + str(not mprls_tank_3.cantConnect) + " MPRLS2: " + str(not mprls_tank_2.cantConnect) + " MPRLS1: " + str(not mprls_tank_1.cantConnect), rtc.getTPlusMS(), output_log)
+    if (collection_3.mprls.cantConnect or collection_2.mprls.cantConnect) and collection_1.mprls.cantConnect: # Not enough pressure information to equalize the tanks
+        mprint.pform(f"Can't connect to two or more of the MPRLS, so we will not attempt to equalize the tanks. Connections - MPRLS3: {not mprls_tank_3.cantConnect} MPRLS2: {not mprls_tank_2.cantConnect} MPRLS1: {not mprls_tank_1.cantConnect}", rtc.getTPlusMS(), output_log)
         return False
     
-    if (pressures.tank_3_pressure > collection_3.up_driving_pressure * 0.9) and not tank_3.sampled:  # If the pressure in the 3rd tank is too big...
-        mprint.pform("Pressure in Tank 3 is too large for collection! - " + str(pressures.tank_3_pressure) + " hPa", rtc.getTPlusMS(), output_log)
-        
-        if pressures.tank_3_pressure < 900: # If the tank is holding *some* sort of vacuum, just not a good one...
-            mprint.pform("Pressure in Tank 3 is below atmospheric", rtc.getTPlusMS(), output_log)
-            
-            if not mprls_tank_1.cantConnect and (pressures.tank_3_pressure + pressures.tank_1_pressure) / 2 < collection_3.up_driving_pressure * 0.9: # Let's equalize tank 1 and tank 3
-                mprint.pform("Pressure in Tank 3 can be equalized with Tank 1. Let's do that", rtc.getTPlusMS(), output_log)
-                valve_1.open()
-                valve_3.open()
-                mprint.pform("VALVE_1 and VALVE_3 pulled HIGH", rtc.getTPlusMS(), output_log)
-                time.sleep(0.1)
-                valve_3.close()
-                valve_1.close()
-                mprint.pform("VALVE_1 and VALVE_3 pulled LOW", rtc.getTPlusMS(), output_log)
-            elif not mprls_tank_2.cantConnect and (pressures.tank_3_pressure + pressures.tank_2_pressure) / 2 < collection_3.up_driving_pressure * 0.9:
-                mprint.pform("Pressure in Tank 3 can be equalized with Tank 2. Let's do that", rtc.getTPlusMS(), output_log)
-                valve_2.open()
-                valve_3.open()
-                mprint.pform("VALVE_2 and VALVE_3 pulled HIGH", rtc.getTPlusMS(), output_log)
-                time.sleep(0.1)
-                valve_3.close()
-                valve_2.close()
-                mprint.pform("VALVE_2 and VALVE_3 pulled LOW", rtc.getTPlusMS(), output_log)
-            else:
-                mprint.pform("Pressure in Tank 3 can't be equalized. We'll sample it on the way down", rtc.getTPlusMS(), output_log)
-                collection_3.sample_upwards = False
-        else: # Tank lost everything in the 5 days we waited. Mark it as dead
-            mprint.pform("Pressure in Tank 3 is atmospheric. Marked it as dead", rtc.getTPlusMS(), output_log)
-            tank_3.dead = True
-            collection_3.sample_upwards = False
-            
-    if (pressures.tank_2_pressure > collection_2.up_driving_pressure * 0.9) and not tank_2.sampled:  # If the pressure in the 2nd tank is too big...
-        mprint.pform("Pressure in Tank 2 is too large for collection! - " + str(pressures.tank_2_pressure) + " hPa", rtc.getTPlusMS(), output_log)
-        
-        if pressures.tank_2_pressure < 900: # If the tank is holding *some* sort of vacuum, just not a good one...
-            mprint.pform("Pressure in Tank 2 is below atmospheric", rtc.getTPlusMS(), output_log)
-            
-            if not mprls_tank_1.cantConnect and (pressures.tank_2_pressure + pressures.tank_1_pressure) / 2 < collection_2.up_driving_pressure * 0.9: # Let's equalize tank 1 and tank 2
-                mprint.pform("Pressure in Tank 2 can be equalized with Tank 1. Let's do that", rtc.getTPlusMS(), output_log)    
-                valve_1.open()
-                valve_2.open()
-                mprint.pform("VALVE_1 and VALVE_2 pulled HIGH", rtc.getTPlusMS(), output_log)
-                time.sleep(0.1)
-                valve_2.close()
-                valve_1.close()
-                mprint.pform("VALVE_1 and VALVE_2 pulled LOW", rtc.getTPlusMS(), output_log)
-            else: # Can't equalize the tank, so we'll grab this sample on the way down
-                mprint.pform("Pressure in Tank 2 can't be equalized. We'll sample it on the way down", rtc.getTPlusMS(), output_log)
-                collection_2.sample_upwards = False
-        else: # Tank lost everything in the 5 days we waited. Mark it as dead
-            mprint.pform("Pressure in Tank 2 is atmospheric. Marked it as dead", rtc.getTPlusMS(), output_log)
-            tank_2.dead = True
-            collection_2.sample_upwards = False
+    equalizeCollection(collection_3, (collection_1, collection_2), tank_pressures)
+    equalizeCollection(collection_2, (collection_1,), tank_pressures)
     
     return True
     
@@ -633,6 +792,10 @@ def equalizeTanks():
 
 equalizeTanks()
 
+# Everything from here on is timed, so the pressures are logged by the sampler thread from now on
+sampler.start()
+mprint.pform("Sampler started", rtc.getTPlusMS(), output_log)
+
 
 """
     Upwards sampling management
@@ -640,202 +803,183 @@ equalizeTanks()
     TODO: Change logic to sample on way up if a sample tank holds a good pressure,
     but the bleed tank is dead / full. Instead, vent to space for a moment and then collect.
 """
+def startInsideBleed(collection):
+    """Open the bleed tank to bleed the lines before a collection."""
+    mprint.pform(f"Beginning inside bleed for sample collection {collection.num}", rtc.getTPlusMS(), output_log)
+    tank_bleed.open()
+    mprint.pform("VALVE_BLEED pulled HIGH", rtc.getTPlusMS(), output_log, level=DEBUG)
+
+def endInsideBleed():
+    """Close the bleed tank after bleeding the lines."""
+    tank_bleed.close()
+    mprint.pform("VALVE_BLEED pulled LOW", rtc.getTPlusMS(), output_log, level=DEBUG)
+
+def startSample(collection):
+    """Open the main and tank valves for a collection."""
+    mprint.pform(f"Beginning sampling for sample collection {collection.num}", rtc.getTPlusMS(), output_log)
+    Valve.openMany((valve_main, collection.tank.valve))
+    mprint.pform(f"VALVE_MAIN and VALVE_{collection.tank.valve.name} pulled HIGH", rtc.getTPlusMS(), output_log, level=DEBUG)
+
+def endSample(collection, threshold):
+    """
+    Close the main and tank valves for a collection and check how well the tank filled.
+    
+    threshold: The tank pressure the sample has to clear, in hPa
+    
+    Returns
+    -------
+    Whether we're done with this collection, i.e. the tank cleared the threshold,
+    we can't read its MPRLS, or we've tried SAMPLE_TRIES times
+    The tank pressure in hPa
+    """
+    tank_valve = collection.tank.valve
+    Valve.closeMany((valve_main, tank_valve))
+    mprint.pform(f"VALVE_MAIN and VALVE_{tank_valve.name} pulled LOW", rtc.getTPlusMS(), output_log, level=DEBUG)
+    
+    collection.markSampled()
+    pressure = collection.mprls.pressure
+    return collection.mprls.cantConnect or pressure > threshold or collection.sampled_count >= SAMPLE_TRIES, pressure
+
+
+def sampleUpwards(collection):
+    """
+    Sample a collection on the way up, trying up to SAMPLE_TRIES times.
+    
+    The whole chain, bleeds and retries included, finishes before this returns,
+    so no two collections ever have their valves open at the same time.
+    """
+    while True:
+        collection.sampled_count += 1
+        mprint.pform(f"Waiting for upwards sample collection {collection.num} at {collection.up_start_time} ms. Try #{collection.sampled_count}", rtc.getTPlusMS(), output_log)
+        waitUntil(collection.up_start_time)
+        
+        if collection.upwards_bleed:
+            mprint.pform(f"Checking bleed tank pressure for sample collection {collection.num}", rtc.getTPlusMS(), output_log)
+            temp_bleed_pressure = mprls_bleed.pressure
+            if mprls_bleed.cantConnect or temp_bleed_pressure > collection.up_driving_pressure: # There's no way in hell we're bleeding off this thing. 
+                mprint.pform(f"!! Sample collection {collection.num} requires a full bleed for a driving pressure of {collection.up_driving_pressure} hPa, but our bleed tank is at {temp_bleed_pressure} hPa. Thus, we'll opt to sample this on the way down!", rtc.getTPlusMS(), output_log)
+                collection.sample_upwards = False     # Mark this collection for sampling on the way down
+                return
+            mprint.pform(f"Sample collection {collection.num} requires a full bleed for a driving pressure of {collection.up_driving_pressure} hPa, which is greater than the bleed tank pressure of {temp_bleed_pressure} hPa.", rtc.getTPlusMS(), output_log)
+            
+            mprint.pform(f"Beginning outside bleed for sample collection {collection.num}", rtc.getTPlusMS(), output_log)
+            valve_main.open()
+            mprint.pform("VALVE_MAIN pulled HIGH", rtc.getTPlusMS(), output_log, level=DEBUG)
+            waitUntil(rtc.getTPlusMS() + 100)
+            valve_main.close()
+            mprint.pform("VALVE_MAIN pulled LOW", rtc.getTPlusMS(), output_log, level=DEBUG)
+            
+            startInsideBleed(collection)
+            waitUntil(rtc.getTPlusMS() + collection.bleed_window)
+            endInsideBleed()
+        
+        startSample(collection)
+        waitUntil(rtc.getTPlusMS() + collection.up_duration)
+        done, pressure = endSample(collection, collection.up_threshold)
+        
+        if not done:
+            mprint.pform(f"Tank {collection.tank.valve.name} pressure still too low! - {pressure}", rtc.getTPlusMS(), output_log)
+            continue
+        if not collection.mprls.cantConnect and pressure <= collection.up_threshold:   # Out of tries
+            mprint.pform(f"Tank {collection.tank.valve.name} pressure still too low! - {pressure} hPa. We'll sample it on the way down", rtc.getTPlusMS(), output_log)
+            collection.sample_upwards = False     # Mark this collection for sampling on the way down
+        else:
+            mprint.pform(f"Finished sampling Tank {collection.tank.valve.name} - {pressure} hPa", rtc.getTPlusMS(), output_log)
+        return
+
+# One collection at a time, in order, sleeping between steps while the sampler logs the pressures
 for collection in collections:
     if collection.sample_upwards:
         if collection.tank.dead:
-            mprint.pform("Sample collection " + collection.num + " at " + str(collection.up_start_time) + " ms has a dead tank! We'll sample it on the way down at " + str(collection.down_start_time) + " ms", rtc.getTPlusMS(), output_log)
+            mprint.pform(f"Sample collection {collection.num} at {collection.up_start_time} ms has a dead tank! We'll sample it on the way down at {collection.down_start_time} ms", rtc.getTPlusMS(), output_log)
             collection.sample_upwards = False
             continue
-        while True:
-            collection.sampled_count += 1
-            mprint.pform("Waiting for upwards sample collection " + collection.num + " at " + str(collection.up_start_time) + " ms. Try #" + str(collection.sampled_count), rtc.getTPlusMS(), output_log)
-            while rtc.getTPlusMS() < collection.up_start_time:
-                logPressures()
-            
-            if collection.upwards_bleed:
-                mprint.pform("Checking bleed tank pressure for sample collection " + str(collection.num), rtc.getTPlusMS(), output_log)
-                temp_bleed_pressure = mprls_bleed.pressure
-                if mprls_bleed.cantConnect or temp_bleed_pressure > collection.up_driving_pressure: # There's no way in hell we're bleeding off this thing. 
-                    mprint.pform("!! Sample collection " + str(collection.num) + 
-                                 " requires a full bleed for a driving pressure of " + str(collection.up_driving_pressure) + 
-                                 " hPa, but our bleed tank is at " + str(temp_bleed_pressure) + 
-                                 " hPa. Thus, we'll opt to sample this on the way down!", rtc.getTPlusMS(), output_log)
-                    collection.sample_upwards = False     # Mark this collection for sampling on the way down
-                    break
-                else:
-                    mprint.pform("Sample collection " + str(collection.num) + " requires a full bleed for a driving pressure of " + str(collection.up_driving_pressure) + 
-                                 " hPa, which is greater than the bleed tank pressure of " + str(temp_bleed_pressure) + " hPa.", rtc.getTPlusMS(), output_log)
-                
-                mprint.pform("Beginning outside bleed for sample collection " + collection.num, rtc.getTPlusMS(), output_log)
-                valve_main.open()
-                mprint.pform("VALVE_MAIN pulled HIGH", rtc.getTPlusMS(), output_log)
-                time.sleep(0.1)
-                valve_main.close()
-                mprint.pform("VALVE_MAIN pulled LOW", rtc.getTPlusMS(), output_log)
-                
-                mprint.pform("Beginning inside bleed for sample collection " + collection.num, rtc.getTPlusMS(), output_log)
-                tank_bleed.open()
-                mprint.pform("VALVE_BLEED pulled HIGH", rtc.getTPlusMS(), output_log)
-                sample_bleed_starttime = rtc.getTPlusMS()
-                while rtc.getTPlusMS() - sample_bleed_starttime < collection.bleed_duration + 50:    # +50ms, just to ensure we get everything out
-                    logPressures()
-                tank_bleed.close()
-                mprint.pform("VALVE_BLEED pulled LOW", rtc.getTPlusMS(), output_log)
-            
-            mprint.pform("Beginning sampling for sample collection " + collection.num, rtc.getTPlusMS(), output_log)
-            valve_main.open()
-            collection.tank.valve.open()
-            mprint.pform("VALVE_MAIN and VALVE_" + collection.tank.valve.name + " pulled HIGH", rtc.getTPlusMS(), output_log)
-            sample_starttime = rtc.getTPlusMS()
-            while rtc.getTPlusMS() - sample_starttime < collection.up_duration:
-                logPressures()
-            valve_main.close()
-            collection.tank.valve.close()
-            mprint.pform("VALVE_MAIN and VALVE_" + collection.tank.valve.name + " pulled LOW", rtc.getTPlusMS(), output_log)
-            
-            logPressures()
-            collection.tank.sampled = True
-            collection.sampled = True
-            pressure = collection.mprls.pressure
-            
-            if collection.mprls.cantConnect or pressure > collection.up_driving_pressure * 0.9 or collection.sampled_count >= 3:
-                if not collection.mprls.cantConnect and pressure <= collection.up_driving_pressure * 0.9:
-                    mprint.pform("Tank " + str(collection.tank.valve.name) + " pressure still too low! - " + str(pressure) + " hPa. We'll sample it on the way down", rtc.getTPlusMS(), output_log)
-                    collection.sample_upwards = False     # Mark this collection for sampling on the way down
-                else:
-                    mprint.pform("Finished sampling Tank " + str(collection.tank.valve.name) + " - " + str(pressure) + " hPa", rtc.getTPlusMS(), output_log)
-                break   # Terminate the loop once we get the correct pressure or we've sampled too many times
-            mprint.pform("Tank " + str(collection.tank.valve.name) + " pressure still too low! - " + str(pressure), rtc.getTPlusMS(), output_log)
+        sampleUpwards(collection)
     else:
-        mprint.pform("NOT sampling collection " + str(collection.num) + " on the way up. Instead, we'll sample it on the way down at " + str(collection.down_start_time) + " ms", rtc.getTPlusMS(), output_log)
-
+        mprint.pform(f"NOT sampling collection {collection.num} on the way up. Instead, we'll sample it on the way down at {collection.down_start_time} ms", rtc.getTPlusMS(), output_log)
 
 """
     Downwards sampling management
 """
-all_good = True
-for collection in collections:
-    if not collection.sample_upwards: all_good = False
+failed_collections = [collection for collection in collections if not collection.sample_upwards]
 
-if not all_good:
+if failed_collections:
     mprint.pform("1 or more collections did not occur successfully! We'll prep to take those samples on the way down", rtc.getTPlusMS(), output_log)
     
-    any_dead = False
-    for collection in collections:
-        if collection.tank.dead: any_dead = True 
+    dead_collections = [collection for collection in failed_collections if collection.tank.dead] # A dead tank always pushes its collection down
     
-    if any_dead:
+    if dead_collections:
         mprint.pform("Waiting for dead-test at 160000 ms.", rtc.getTPlusMS(), output_log)
-        while rtc.getTPlusMS() < 160000:
-            logPressures()
+        waitUntil(160000)
         
         # The dead-test checks to see if the seal between the valve and the tank has been broken.
         mprint.pform("Performing dead-test", rtc.getTPlusMS(), output_log)
-        for collection in collections:
-            if collection.tank.dead:
-                mprint.pform("Testing Tank " + collection.tank.valve.name, rtc.getTPlusMS(), output_log)
-                
-                start_canister_pressure = mprls_canister.triple_pressure
-                mprint.pform("Starting canister pressure - " + str(start_canister_pressure) + " hPa", rtc.getTPlusMS(), output_log)
-                
-                valve_main.open()
-                collection.tank.valve.open()
-                mprint.pform("VALVE_MAIN and VALVE_" + collection.tank.valve.name + " pulled HIGH", rtc.getTPlusMS(), output_log)
-                
-                test_starttime = rtc.getTPlusMS()
-                while rtc.getTPlusMS() - test_starttime < 1000: # Open the tank for 1 second
-                    logPressures()
-                
-                valve_main.close()
-                collection.tank.valve.close()
-                mprint.pform("VALVE_MAIN and VALVE_" + collection.tank.valve.name + " pulled LOW", rtc.getTPlusMS(), output_log)
-                
-                end_canister_pressure = mprls_canister.triple_pressure
-                mprint.pform("Ending canister pressure - " + str(end_canister_pressure) + " hPa", rtc.getTPlusMS(), output_log)
-                # TODO: Can we get a real number for this? I'm just using 3 hPa based on the known STD of the sensors
-                if start_canister_pressure - end_canister_pressure < 3: # We just leaked 3 hPa from the WHOLE FUCKING ROCKET in 1 second
-                    mprint.pform("The difference of pressures of " + str(start_canister_pressure - end_canister_pressure) + " hPa is negligible. Marked Tank " + collection.tank.valve.name + " for use.", rtc.getTPlusMS(), output_log)
-                    collection.tank.dead = False
-                else:
-                    mprint.pform("The difference of pressures of " + str(start_canister_pressure - end_canister_pressure) + " hPa is SIGNIFICANT! We will keep Tank " + collection.tank.valve.name + " marked as dead.", rtc.getTPlusMS(), output_log)
+        for collection in dead_collections:
+            tank_valve = collection.tank.valve
+            mprint.pform(f"Testing Tank {tank_valve.name}", rtc.getTPlusMS(), output_log)
+            
+            start_canister_pressure = mprls_canister.triple_pressure
+            mprint.pform(f"Starting canister pressure - {start_canister_pressure} hPa", rtc.getTPlusMS(), output_log)
+            
+            Valve.openMany((valve_main, tank_valve))
+            mprint.pform(f"VALVE_MAIN and VALVE_{tank_valve.name} pulled HIGH", rtc.getTPlusMS(), output_log, level=DEBUG)
+            
+            waitUntil(rtc.getTPlusMS() + 1000) # Open the tank for 1 second
+            
+            Valve.closeMany((valve_main, tank_valve))
+            mprint.pform(f"VALVE_MAIN and VALVE_{tank_valve.name} pulled LOW", rtc.getTPlusMS(), output_log, level=DEBUG)
+            
+            end_canister_pressure = mprls_canister.triple_pressure
+            mprint.pform(f"Ending canister pressure - {end_canister_pressure} hPa", rtc.getTPlusMS(), output_log)
+            # TODO: Can we get a real number for this? I'm just using 3 hPa based on the known STD of the sensors
+            delta = start_canister_pressure - end_canister_pressure
+            if delta < DEAD_DELTA_HPA: # We just leaked 3 hPa from the WHOLE FUCKING ROCKET in 1 second
+                mprint.pform(f"The difference of pressures of {delta} hPa is negligible. Marked Tank {tank_valve.name} for use.", rtc.getTPlusMS(), output_log)
+                collection.tank.dead = False
+            else:
+                mprint.pform(f"The difference of pressures of {delta} hPa is SIGNIFICANT! We will keep Tank {tank_valve.name} marked as dead.", rtc.getTPlusMS(), output_log)
     
     mprint.pform("Waiting for apogee at 170000 ms to vent.", rtc.getTPlusMS(), output_log)
-    while rtc.getTPlusMS() < 170000:
-        logPressures()
+    waitUntil(170000)
         
     mprint.pform("We're at the apogee!", rtc.getTPlusMS(), output_log)
-    valve_main.open()
-    valve_bleed.open()
-    mprint.pform("VALVE_MAIN and VALVE_BLEED pulled HIGH", rtc.getTPlusMS(), output_log)
+    vent_collections = [collection for collection in failed_collections if not collection.tank.dead] # Tanks that failed the dead-test stay out
+    Valve.openMany([valve_main, valve_bleed] + [collection.tank.valve for collection in vent_collections]) # Vent everything we'll sample on the way down in one write
+    mprint.pform("VALVE_MAIN and VALVE_BLEED pulled HIGH", rtc.getTPlusMS(), output_log, level=DEBUG)
     
-    for collection in collections:
-        if not collection.sample_upwards and not collection.tank.dead:
-            collection.tank.valve.open()
-            collection.tank.sampled = False
-            collection.sampled = False
-            collection.sampled_count = 0
-            mprint.pform("VALVE_" + collection.tank.valve.name + " pulled HIGH", rtc.getTPlusMS(), output_log)
+    for collection in vent_collections:
+        collection.resetForDown()
+        mprint.pform(f"VALVE_{collection.tank.valve.name} pulled HIGH", rtc.getTPlusMS(), output_log, level=DEBUG)
         
-    while rtc.getTPlusMS() < 175000:
-        logPressures()
+    waitUntil(175000)
     
-    valve_main.close()
-    valve_bleed.close()
-    valve_1.close()
-    valve_2.close()
-    valve_3.close()
-    mprint.pform("ALL VALVES pulled LOW", rtc.getTPlusMS(), output_log)
+    Valve.closeMany(valves_all)
+    mprint.pform("ALL VALVES pulled LOW", rtc.getTPlusMS(), output_log, level=DEBUG)
+    
+    for collection in collections:
+        if collection not in vent_collections:
+            mprint.pform(f"NOT sampling collection {collection.num} on the way down", rtc.getTPlusMS(), output_log)
     
     # Reverse the order of the collections because the highest collections are now first
-    rev_collections = [None] * len(collections)
-    i = len(collections) - 1
-    f = 0
-    while i >= 0:
-        rev_collections[f] = collections[i]
-        i-=1
-        f+=1
-    
-    for collection in rev_collections:
-        if not collection.sample_upwards and not collection.tank.dead:
-            while True:
-                collection.sampled_count += 1
-                mprint.pform("Waiting for downwards sample collection " + collection.num + " at " + str(collection.down_start_time) + " ms. Try #" + str(collection.sampled_count), rtc.getTPlusMS(), output_log)
-                while rtc.getTPlusMS() < collection.down_start_time:
-                    logPressures()
-                
-                # Is this bleed unnecessary?
-                mprint.pform("Beginning inside bleed for sample collection " + collection.num, rtc.getTPlusMS(), output_log)
-                tank_bleed.open()
-                mprint.pform("VALVE_BLEED pulled HIGH", rtc.getTPlusMS(), output_log)
-                sample_bleed_starttime = rtc.getTPlusMS()
-                while rtc.getTPlusMS() - sample_bleed_starttime < collection.bleed_duration + 50:   # +50ms, just to ensure we get everything out
-                    logPressures()
-                tank_bleed.close()
-                mprint.pform("VALVE_BLEED pulled LOW", rtc.getTPlusMS(), output_log)
-                
-                mprint.pform("Beginning sampling for sample collection " + collection.num, rtc.getTPlusMS(), output_log)
-                valve_main.open()
-                collection.tank.valve.open()
-                mprint.pform("VALVE_MAIN and VALVE_" + collection.tank.valve.name + " pulled HIGH", rtc.getTPlusMS(), output_log)
-                sample_starttime = rtc.getTPlusMS()
-                while rtc.getTPlusMS() - sample_starttime < collection.down_duration:
-                    logPressures()
-                valve_main.close()
-                collection.tank.valve.close()
-                mprint.pform("VALVE_MAIN and VALVE_" + collection.tank.valve.name + " pulled LOW", rtc.getTPlusMS(), output_log)
-                
-                logPressures()
-                collection.tank.sampled = True
-                collection.sampled = True
-                pressure = collection.mprls.pressure
-                
-                if collection.mprls.cantConnect or pressure > collection.down_driving_pressure * 0.9 or collection.sampled_count >= 3:
-                    mprint.pform("Finished sampling Tank " + collection.tank.valve.name + " - " + str(pressure) + " hPa", rtc.getTPlusMS(), output_log)
-                    break   # Terminate the loop once we get the correct pressure or we've sampled too many times
-                mprint.pform("Tank " + collection.tank.valve.name + " pressure still too low! - " + str(pressure), rtc.getTPlusMS(), output_log)
-                
-        else:
-            mprint.pform("NOT sampling collection " + collection.num + " on the way down", rtc.getTPlusMS(), output_log)
+    for collection in reversed(vent_collections):
+        while True:
+            collection.sampled_count += 1
+            mprint.pform(f"Waiting for downwards sample collection {collection.num} at {collection.down_start_time} ms. Try #{collection.sampled_count}", rtc.getTPlusMS(), output_log)
+            waitUntil(collection.down_start_time)
+            
+            # Is this bleed unnecessary?
+            startInsideBleed(collection)
+            waitUntil(rtc.getTPlusMS() + collection.bleed_window)
+            endInsideBleed()
+            
+            startSample(collection)
+            waitUntil(rtc.getTPlusMS() + collection.down_duration)
+            done, pressure = endSample(collection, collection.down_threshold)
+            
+            if done:
+                mprint.pform(f"Finished sampling Tank {collection.tank.valve.name} - {pressure} hPa", rtc.getTPlusMS(), output_log)
+                break   # Terminate the loop once we get the correct pressure or we've sampled too many times
+            mprint.pform(f"Tank {collection.tank.valve.name} pressure still too low! - {pressure}", rtc.getTPlusMS(), output_log)
 
 else:
     mprint.pform("We sampled everything on the way up sucessfully! Let's shut it down.", rtc.getTPlusMS(), output_log)
@@ -845,23 +989,40 @@ else:
     Clean everything up
 """
 # Close the GPIO setup
-valve_main.close()
-valve_bleed.close()
-valve_1.close()
-valve_2.close()
-valve_3.close()
+sampler.stop()
+mprint.pform("Sampler stopped", rtc.getTPlusMS(), output_log)
+if multiplex != False:
+    try:
+        multiplex.deselect()    # Multiplexer leaves the last channel attached to the bus, so detach it before we go
+        mprint.pform("Multiplexer channels deselected", rtc.getTPlusMS(), output_log)
+    except Exception as e:
+        mprint.pform(f"COULD NOT DESELECT THE MULTIPLEXER! Error: {e}", rtc.getTPlusMS(), output_log)
+Valve.closeMany(valves_all)
 GPIO.cleanup()
 mprint.pform("Cleaned up the GPIO", rtc.getTPlusMS(), output_log)
 
 # Save the current time to the system
 mprint.pform("Saving the current time to the system...", rtc.getTPlusMS(), output_log)
-os.system("fake-hwclock save")
+try:
+    subprocess.run(["fake-hwclock", "save"])
+except OSError as e:    # Unlike os.system, a missing program raises
+    mprint.pform(f"COULD NOT SAVE THE TIME! Error: {e}", rtc.getTPlusMS(), output_log)
 mprint.pform("Done saving current time.", rtc.getTPlusMS(), output_log)
 
 # Close the output files
 mprint.pform("A mimir...", rtc.getTPlusMS(), output_log)
-output_log.close()
-output_pressures.close()
+mprint.close()  # Let the writer thread finish before the files go away
+for output in (output_log, output_pressures):
+    try:
+        output.flush()
+        os.fsync(output.fileno())   # close() only hands the data to the page cache, and the shutdown could beat it to the SD card
+    except (IOError, ValueError) as e:
+        print(f"COULD NOT SYNC {output.name}! Error: {e}")
+    output.close()
+os.sync()   # Commit anything else still in the page cache
 
 # Shutdown the system (No going back!)
-os.system("shutdown now")
\ No newline at end of file
+try:
+    subprocess.run(["shutdown", "now"])
+except OSError as e:
+    print(f"COULD NOT SHUT DOWN! Error: {e}")
\ No newline at end of file
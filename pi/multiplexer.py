@@ -0,0 +1,81 @@
+'''
+A TCA9548A that remembers which channel is selected, so back to back reads on one channel don't reselect it
+'''
+
+import time
+import threading
+import adafruit_tca9548a
+
+class MultiplexerChannel(adafruit_tca9548a.TCA9548A_Channel):
+    """
+    A TCA9548A channel that only writes the control register when a different channel was selected last.
+
+    The stock channel selects itself on every lock and deselects on every unlock,
+    which is two extra writes on the bus for every MPRLS transaction.
+    
+    This changes how the bus is wired: after a transaction, the last channel stays
+    attached to the main bus until another channel is used or Multiplexer.deselect()
+    is called. That's safe here because nothing on the main bus (the DS3231 at 0x68)
+    shares an address with the MPRLS' at 0x18.
+    
+    Relies on the internals of adafruit_tca9548a (tca.i2c, tca.address, channel_switch),
+    so the library version is pinned in requirements.txt.
+    """
+
+    def __init__(self, tca, channel):
+        super().__init__(tca, channel)
+        self.channel = channel
+
+    def try_lock(self):
+        """Lock the bus, and select this channel if it isn't already."""
+        self.tca.lock.acquire()     # The bus' own try_lock isn't safe between threads
+        while not self.tca.i2c.try_lock():
+            time.sleep(0)
+        if self.tca.selected != self.channel:
+            try:
+                self.tca.i2c.writeto(self.tca.address, self.channel_switch)
+            except:
+                self.tca.selected = None    # We don't know what the multiplexer has selected anymore
+                self.tca.i2c.unlock()
+                self.tca.lock.release()
+                raise
+            self.tca.selected = self.channel
+        return True
+
+    def unlock(self):
+        """Unlock the bus, leaving this channel selected for the next transaction."""
+        try:
+            return self.tca.i2c.unlock()
+        finally:
+            self.tca.lock.release()
+
+class Multiplexer(adafruit_tca9548a.TCA9548A):
+    """
+    A TCA9548A whose channels cache the selected channel.
+
+    Only the channels handed out by this object should talk through the multiplexer,
+    otherwise the cached selection is wrong. Set selected to None after any outside use.
+    """
+
+    def __init__(self, i2c, address=0x70):
+        super().__init__(i2c, address)
+        self.selected = None    # The channel the multiplexer currently has selected, None if unknown
+        self.lock = threading.Lock()    # Held by whichever channel has the bus, so threads can share the multiplexer
+
+    def deselect(self):
+        """Detach every channel from the main bus, like the stock TCA9548A leaves it after each transaction."""
+        with self.lock:
+            while not self.i2c.try_lock():
+                time.sleep(0)
+            try:
+                self.selected = None    # No channel, so the next transaction selects its own
+                self.i2c.writeto(self.address, b"\x00")
+            finally:
+                self.i2c.unlock()
+
+    def __getitem__(self, key):
+        if not 0 <= key <= 7:
+            raise IndexError("Channel must be an integer in the range: 0-7.")
+        if self.channels[key] is None:
+            self.channels[key] = MultiplexerChannel(self, key)
+        return self.channels[key]
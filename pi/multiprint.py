@@ -1,10 +1,109 @@
-import sys
 import os
+import time
+import atexit
+import queue
+import threading
+
+# fdatasync skips the inode timestamp updates that fsync also journals. Only Linux has it
+_datasync = getattr(os, "fdatasync", os.fsync)
+
+# Message levels, lowest first. pform drops messages below the printer's level
+DEBUG = 10
+INFO = 20
 
 class MultiPrinter:
+    """
+    Prints and writes lines on a background thread.
+    
+    The caller only puts the line on a queue, so the flight loop never waits
+    on the terminal or the SD card. Call close() before closing any of the
+    files written to, so everything queued makes it to the disk first.
+    
+    level:  pform messages below this level are dropped before they're formatted
+    sync_interval:  How often written lines are fsynced to the disk, in s. Lines are
+                    still flushed to the OS right away, so only a power cut can lose them
+    """
     
-    def __init__(self):
+    def __init__(self, level=DEBUG, sync_interval=1.0):
         self.ready = True
+        self.level = level
+        self.sync_interval = sync_interval
+        self.queue = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self._run, name="MultiPrinter", daemon=True)
+        self.writer.start()
+        atexit.register(self.close) # Don't lose what's queued if the script dies
+    
+    def _run(self):
+        """
+        Print and write queued lines until close() is called.
+        
+        Everything that queued up while the last batch was being written is
+        written together, with one flush per file. The fsyncs are held back
+        until sync_interval has passed, or a sync() asks for them.
+        """
+        dirty = []      # Files flushed to the OS but not yet fsynced
+        last_sync = time.monotonic()
+        while True:
+            batch = []
+            try:
+                if dirty:   # Only wait as long as the pending fsync allows
+                    batch.append(self.queue.get(timeout=max(0, last_sync + self.sync_interval - time.monotonic())))
+                else:
+                    batch.append(self.queue.get())
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            
+            closing = False
+            force_sync = False
+            files = []
+            for item in batch:
+                if item is None:
+                    closing = True
+                    continue
+                message, f, echo = item
+                try:
+                    if isinstance(message, tuple):  # A pform message, formatted here instead of by the caller
+                        message, tPlus = message
+                        message = f"T+ {tPlus} ms\t{message}"
+                    if echo:
+                        print(message)
+                    if message is not None:
+                        f.write(message + "\n") # File.write doesn't automatically add a newline
+                    else:
+                        force_sync = True   # sync() wants this on the disk now
+                except (IOError, ValueError) as e:
+                    print("COULD NOT WRITE TO THE INPUT FILE! Error: {}".format(e))
+                if f not in files:
+                    files.append(f)
+            
+            for f in files:
+                try:
+                    f.flush()               # Flush the data to the OS, which is cheap
+                except (IOError, ValueError) as e:
+                    print("COULD NOT WRITE TO THE INPUT FILE! Error: {}".format(e))
+                if f not in dirty:
+                    dirty.append(f)
+            
+            # This process should take roughly 1 ms / 1 KB written, so it's only done every sync_interval
+            if closing or force_sync or time.monotonic() - last_sync >= self.sync_interval:
+                for f in dirty:
+                    try:
+                        _datasync(f.fileno())   # Force the operating system to write the data to disk
+                    except (IOError, ValueError) as e:
+                        print("COULD NOT WRITE TO THE INPUT FILE! Error: {}".format(e))
+                dirty = []
+                last_sync = time.monotonic()
+            
+            if closing:
+                return
+    
+    def close(self):
+        """Finish everything that's queued and stop the writer thread."""
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
     
     def p(self, message, f):
         """
@@ -15,29 +114,31 @@ class MultiPrinter:
         f:          The file to write to
         
         """
-        print(message)
-        self.w(message, f)
+        self.queue.put((message, f, True))
             
     def w(self, message, f):
         """
         Only write and flush to the file
         """
+        self.queue.put((message, f, False))
+    
+    def sync(self, f):
+        """
+        Flush and fsync a file from the writer thread, without writing anything to it.
         
-        # This process should take roughly 1 ms / 1 KB written. f.flush and os.fsync should have execution times in the order of microseconds.
-        try:
-            f.write(message + "\n") # File.write doesn't automatically add a newline
-            f.flush()               # Flush the data to the file
-            os.fsync(f.fileno())    # Force the operating system to write the data to disk
-        except IOError as e:
-            print("COULD NOT WRITE TO THE INPUT FILE! Error: {}".format(e))
+        f:          The file to push to the disk
+        """
+        self.queue.put((None, f, False))
             
-    def pform(self, message, tPlus, f):
+    def pform(self, message, tPlus, f, level=INFO):
         """
         message:    The message to print and write
         tPlus:      The mission tPlus
         f:          The file to write to
+        level:      DEBUG or INFO. Dropped if it's below the printer's level
         
         Print to both the screen and a specified file and prepend the T+.
         """
-        print("T+ " + str(tPlus) + " ms\t" + message)
-        self.w("T+ " + str(tPlus) + " ms\t" + message, f)
\ No newline at end of file
+        if level < self.level:
+            return
+        self.queue.put(((message, tPlus), f, True))
\ No newline at end of file